@@ -1,218 +1,294 @@
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from sqlalchemy import create_engine, text
-import time
+from sqlalchemy import create_engine
 import numpy as np
 
-print("--- Iniciando Script ETL (Modo Forçado) ---")
+# CSV relativo ao módulo: funciona no contêiner do ETL e quando importado pela API
+ARQUIVO_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'supply_chain_data.csv')
+
+# Colunas do Kaggle efetivamente usadas na transformação
+COLUNAS_CSV = [
+    'SKU', 'Supplier name', 'Shipping carriers', 'Product type', 'Location',
+    'Transportation modes', 'Revenue generated', 'Manufacturing costs', 'Shipping costs',
+    'Defect rates', 'Number of products sold', 'Price', 'Stock levels'
+]
+
+# Conexões simultâneas usadas no COPY das tabelas fato
+ETL_COPY_WORKERS = int(os.getenv("ETL_COPY_WORKERS", "4"))
 
 # --- 1. Conexão com o Banco ---
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    print("Erro: DATABASE_URL não definida.")
-    exit()
-
-try:
-    engine = create_engine(DATABASE_URL)
-    with engine.connect() as conn:
-        print("Conexão com PostgreSQL (Serviço 'db') estabelecida.")
-except Exception as e:
-    print(f"Erro fatal ao conectar ao banco: {e}")
-    exit()
+def criar_engine(database_url):
+    # Pool pequeno: o ETL é um worker em lote, não precisa de concorrência
+    return create_engine(database_url, pool_size=2, pool_pre_ping=True)
 
 # --- 2. Criação dos Schemas e Tabelas OLAP (AGORA COM DROP) ---
-def recriar_schema_olap():
-    print("Recriando tabelas OLAP (DROP & CREATE)...")
-    with engine.connect() as conn:
-        with conn.begin(): # Transação atômica para recriar tudo
-            conn.execute(text("CREATE SCHEMA IF NOT EXISTS olap"))
-            
-            # --- 2.1. PRIMEIRO: Destruir tabelas antigas (na ordem correta por causa das FKs) ---
-            print("Apagando tabelas antigas...")
-            conn.execute(text("DROP TABLE IF EXISTS olap.fato_vendas_logistica CASCADE"))
-            conn.execute(text("DROP TABLE IF EXISTS olap.fato_estoque_analitico CASCADE"))
-            conn.execute(text("DROP TABLE IF EXISTS olap.dim_produto CASCADE"))
-            conn.execute(text("DROP TABLE IF EXISTS olap.dim_fornecedor CASCADE"))
-            conn.execute(text("DROP TABLE IF EXISTS olap.dim_transportadora CASCADE"))
-            conn.execute(text("DROP TABLE IF EXISTS olap.dim_tempo CASCADE"))
-
-            # --- 2.2. SEGUNDO: Criar tabelas novas (com as colunas corretas) ---
-            print("Criando tabelas novas...")
-            
-            # Dimensões
-            conn.execute(text("""
-                CREATE TABLE olap.dim_produto (
-                    sku_id VARCHAR PRIMARY KEY,
-                    nome_produto VARCHAR,
-                    categoria VARCHAR,
-                    custo_fabricacao FLOAT,
-                    preco_venda FLOAT
-                );
-            """))
-            conn.execute(text("""
-                CREATE TABLE olap.dim_fornecedor (
-                    forn_id VARCHAR PRIMARY KEY,
-                    nome_fornecedor VARCHAR,
-                    localizacao VARCHAR
-                );
-            """))
-            conn.execute(text("""
-                CREATE TABLE olap.dim_transportadora (
-                    transp_id VARCHAR PRIMARY KEY,
-                    nome_transportadora VARCHAR,
-                    modal VARCHAR
-                );
-            """))
-            conn.execute(text("""
-                CREATE TABLE olap.dim_tempo (
-                    data_id DATE PRIMARY KEY,
-                    ano INT,
-                    mes INT,
-                    dia INT
-                );
-            """))
-
-            # Fatos
-            conn.execute(text("""
-                CREATE TABLE olap.fato_vendas_logistica (
-                    id SERIAL PRIMARY KEY,
-                    data_id DATE REFERENCES olap.dim_tempo(data_id),
-                    sku_id VARCHAR REFERENCES olap.dim_produto(sku_id),
-                    forn_id VARCHAR REFERENCES olap.dim_fornecedor(forn_id),
-                    transp_id VARCHAR REFERENCES olap.dim_transportadora(transp_id),
-                    receita_total FLOAT,
-                    custo_total FLOAT,
-                    margem_lucro FLOAT,
-                    qtd_vendida INT,
-                    custo_transporte FLOAT,
-                    flag_entrega_prazo INT,
-                    taxa_nao_conformidade FLOAT
-                );
-            """))
-            conn.execute(text("""
-                CREATE TABLE olap.fato_estoque_analitico (
-                    id SERIAL PRIMARY KEY,
-                    data_id DATE REFERENCES olap.dim_tempo(data_id),
-                    sku_id VARCHAR REFERENCES olap.dim_produto(sku_id),
-                    nivel_estoque INT,
-                    giro_estoque_mensal FLOAT,
-                    risco_ruptura FLOAT
-                );
-            """))
-        print("Schema OLAP recriado com sucesso.")
-
-recriar_schema_olap()
-
-# --- 3. Extração (E) ---
-print("Iniciando Extração (E)...")
-arquivo_csv = '/app/data/supply_chain_data.csv'
-
-try:
-    df_kaggle = pd.read_csv(arquivo_csv)
-    print(f"Arquivo {arquivo_csv} lido com sucesso. {len(df_kaggle)} linhas encontradas.")
-except FileNotFoundError:
-    print(f"ERRO FATAL: Arquivo {arquivo_csv} não encontrado.")
-    exit()
-except Exception as e:
-    print(f"Erro ao ler o arquivo CSV: {e}")
-    exit()
-
-# --- 4. Transformação (T) ---
-print("Iniciando Transformação (T)...")
-df_transformado = df_kaggle.copy()
-
-try:
-    # 4.1. Simulação da 'data_pedido'
-    dias_retroativos = pd.to_timedelta(np.arange(len(df_transformado)), unit='d')
-    df_transformado['data_pedido'] = pd.to_datetime('today') - dias_retroativos
-    df_transformado['data_id'] = df_transformado['data_pedido'].dt.date
-
-    # 4.2. Simulação da 'flag_entrega_prazo'
-    df_transformado['flag_entrega_prazo'] = np.random.choice([0, 1], size=len(df_transformado), p=[0.15, 0.85])
-
-    # 4.3. IDs
-    df_transformado['forn_id'] = 'FORN_' + df_transformado['Supplier name'].astype('category').cat.codes.astype(str)
-    df_transformado['transp_id'] = 'CAR_' + df_transformado['Shipping carriers'].astype('category').cat.codes.astype(str)
-    
-    # 4.4. Padronização
-    df_transformado['sku_id'] = df_transformado['SKU']
-    df_transformado['nome_produto'] = df_transformado['SKU']
-    df_transformado['categoria'] = df_transformado['Product type']
-    df_transformado['nome_fornecedor'] = df_transformado['Supplier name']
-    df_transformado['localizacao'] = df_transformado['Location']
-    df_transformado['nome_transportadora'] = df_transformado['Shipping carriers']
-    df_transformado['modal'] = df_transformado['Transportation modes']
-    df_transformado['receita_total'] = df_transformado['Revenue generated']
-    df_transformado['custo_total'] = df_transformado['Manufacturing costs']
-    df_transformado['custo_transporte'] = df_transformado['Shipping costs']
-    df_transformado['taxa_nao_conformidade'] = df_transformado['Defect rates']
-    df_transformado['qtd_vendida'] = df_transformado['Number of products sold']
-    df_transformado['preco_venda'] = df_transformado['Price']
-    df_transformado['custo_fabricacao'] = df_transformado['Manufacturing costs']
-    df_transformado['nivel_estoque'] = df_transformado['Stock levels']
-    
-    # Limpeza de chaves nulas
-    print("Limpando dados...")
-    df_transformado.dropna(subset=['sku_id', 'forn_id', 'transp_id', 'data_id'], how='any', inplace=True)
-
-    # --- Dimensões ---
-    df_dim_produto = df_transformado[['sku_id', 'nome_produto', 'categoria', 'custo_fabricacao', 'preco_venda']].drop_duplicates(subset=['sku_id'])
-    df_dim_fornecedor = df_transformado[['forn_id', 'nome_fornecedor', 'localizacao']].drop_duplicates(subset=['forn_id'])
-    df_dim_transportadora = df_transformado[['transp_id', 'nome_transportadora', 'modal']].drop_duplicates(subset=['transp_id'])
-    
-    df_dim_tempo = pd.DataFrame({'data_id': df_transformado['data_id'].unique()})
-    df_dim_tempo = df_dim_tempo.drop_duplicates().dropna()
-    df_dim_tempo['data_id'] = pd.to_datetime(df_dim_tempo['data_id'])
-    df_dim_tempo['ano'] = df_dim_tempo['data_id'].dt.year
-    df_dim_tempo['mes'] = df_dim_tempo['data_id'].dt.month
-    df_dim_tempo['dia'] = df_dim_tempo['data_id'].dt.day
-
-    # --- Fatos ---
-    df_fato = df_transformado.copy()
-    df_fato['margem_lucro'] = df_fato['receita_total'] - df_fato['custo_total']
-    
-    colunas_fato_vendas = [
-        'data_id', 'sku_id', 'forn_id', 'transp_id', 'receita_total', 'custo_total', 
-        'margem_lucro', 'qtd_vendida', 'custo_transporte', 'flag_entrega_prazo', 'taxa_nao_conformidade'
-    ]
-    df_fato_vendas_final = df_fato[colunas_fato_vendas]
+# Script único: todo o DDL vai ao banco em uma só ida e volta
+DDL_OLAP = """
+    CREATE SCHEMA IF NOT EXISTS olap;
 
-    df_fato_estoque = df_transformado[['data_id', 'sku_id', 'nivel_estoque']].copy()
-    df_fato_estoque['giro_estoque_mensal'] = np.random.uniform(0.5, 5.0, size=len(df_fato_estoque))
-    df_fato_estoque['risco_ruptura'] = np.random.uniform(0.01, 0.9, size=len(df_fato_estoque))
+    -- 2.1. PRIMEIRO: Destruir tabelas antigas (na ordem correta por causa das FKs)
+    DROP TABLE IF EXISTS olap.fato_vendas_logistica CASCADE;
+    DROP TABLE IF EXISTS olap.fato_estoque_analitico CASCADE;
+    DROP TABLE IF EXISTS olap.dim_produto CASCADE;
+    DROP TABLE IF EXISTS olap.dim_fornecedor CASCADE;
+    DROP TABLE IF EXISTS olap.dim_transportadora CASCADE;
+    DROP TABLE IF EXISTS olap.dim_tempo CASCADE;
 
-    print("Transformação concluída.")
+    -- 2.2. SEGUNDO: Criar tabelas novas (com as colunas corretas)
 
-except Exception as e:
-    print(f"Erro na Transformação (T): {e}")
-    exit()
+    -- Dimensões
+    CREATE TABLE olap.dim_produto (
+        sku_id VARCHAR PRIMARY KEY,
+        nome_produto VARCHAR,
+        categoria VARCHAR,
+        custo_fabricacao FLOAT,
+        preco_venda FLOAT
+    );
+    CREATE TABLE olap.dim_fornecedor (
+        forn_id VARCHAR PRIMARY KEY,
+        nome_fornecedor VARCHAR,
+        localizacao VARCHAR
+    );
+    CREATE TABLE olap.dim_transportadora (
+        transp_id VARCHAR PRIMARY KEY,
+        nome_transportadora VARCHAR,
+        modal VARCHAR
+    );
+    CREATE TABLE olap.dim_tempo (
+        data_id DATE PRIMARY KEY,
+        ano INT,
+        mes INT,
+        dia INT
+    );
 
+    -- Fatos
+    CREATE TABLE olap.fato_vendas_logistica (
+        id SERIAL PRIMARY KEY,
+        data_id DATE REFERENCES olap.dim_tempo(data_id),
+        sku_id VARCHAR REFERENCES olap.dim_produto(sku_id),
+        forn_id VARCHAR REFERENCES olap.dim_fornecedor(forn_id),
+        transp_id VARCHAR REFERENCES olap.dim_transportadora(transp_id),
+        receita_total REAL,
+        custo_total REAL,
+        margem_lucro REAL,
+        qtd_vendida INT,
+        custo_transporte REAL,
+        flag_entrega_prazo SMALLINT,
+        taxa_nao_conformidade REAL
+    );
+    CREATE TABLE olap.fato_estoque_analitico (
+        id SERIAL PRIMARY KEY,
+        data_id DATE REFERENCES olap.dim_tempo(data_id),
+        sku_id VARCHAR REFERENCES olap.dim_produto(sku_id),
+        nivel_estoque INT,
+        giro_estoque_mensal REAL,
+        risco_ruptura REAL
+    );
+"""
 
-# --- 5. Carga (L) ---
-print("Iniciando Carga (L)...")
+def recriar_schema_olap(engine):
+    print("Recriando tabelas OLAP (DROP & CREATE)...")
+    with engine.begin() as conn: # Transação atômica para recriar tudo
+        conn.exec_driver_sql(DDL_OLAP)
+    print("Schema OLAP recriado com sucesso.")
+
+def copiar_csv(cur, df, nome_tabela, schema='olap'):
+    # Serializa o DataFrame como CSV em memória para enviar via COPY
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    colunas = ', '.join(df.columns)
+    cur.copy_expert(f"COPY {schema}.{nome_tabela} ({colunas}) FROM STDIN WITH (FORMAT csv)", buffer)
 
-def carregar_tabela(df, nome_tabela, schema='olap'):
+def carregar_tabela(engine, df, nome_tabela, schema='olap'):
     if df.empty: return
     try:
-        with engine.connect() as conn:
-            with conn.begin():
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
                 # Não precisamos de TRUNCATE aqui porque acabamos de dar DROP/CREATE nas tabelas
                 # Mas mantemos para garantir caso rode duas vezes seguidas sem recriar
-                conn.execute(text(f"TRUNCATE TABLE {schema}.{nome_tabela} RESTART IDENTITY CASCADE"))
-                df.to_sql(nome_tabela, conn, schema=schema, if_exists='append', index=False)
+                cur.execute(f"TRUNCATE TABLE {schema}.{nome_tabela} RESTART IDENTITY CASCADE")
+                copiar_csv(cur, df, nome_tabela, schema)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         print(f"Tabela {schema}.{nome_tabela} carregada com sucesso.")
     except Exception as e:
         print(f"ERRO ao carregar tabela {schema}.{nome_tabela}: {e}")
 
-try:
-    carregar_tabela(df_dim_tempo, 'dim_tempo')
-    carregar_tabela(df_dim_produto, 'dim_produto')
-    carregar_tabela(df_dim_fornecedor, 'dim_fornecedor')
-    carregar_tabela(df_dim_transportadora, 'dim_transportadora')
-    carregar_tabela(df_fato_vendas_final, 'fato_vendas_logistica')
-    carregar_tabela(df_fato_estoque, 'fato_estoque_analitico')
+def copiar_bloco(engine, df, nome_tabela, schema='olap'):
+    # Cada bloco usa sua própria conexão (um backend do Postgres por COPY)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            copiar_csv(cur, df, nome_tabela, schema)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def carregar_fato_paralelo(engine, df, nome_tabela, schema='olap', partes=ETL_COPY_WORKERS):
+    # Fatos não têm chave de negócio (id SERIAL) e são truncadas antes,
+    # então a ordem dos blocos é irrelevante
+    if df.empty: return
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"TRUNCATE TABLE {schema}.{nome_tabela} RESTART IDENTITY CASCADE")
+
+        tamanho = -(-len(df) // partes)
+        blocos = [df.iloc[i:i + tamanho] for i in range(0, len(df), tamanho)]
+        with ThreadPoolExecutor(max_workers=len(blocos)) as executor:
+            list(executor.map(lambda bloco: copiar_bloco(engine, bloco, nome_tabela, schema), blocos))
+        print(f"Tabela {schema}.{nome_tabela} carregada com sucesso ({len(blocos)} blocos em paralelo).")
+    except Exception as e:
+        print(f"ERRO ao carregar tabela {schema}.{nome_tabela}: {e}")
+
+# --- ETL completo (chamado pelo __main__ e pelo agendador da API) ---
+def run_etl(engine, arquivo_csv=ARQUIVO_CSV):
+    print("--- Iniciando Script ETL (Modo Forçado) ---")
+
+    recriar_schema_olap(engine)
+
+    # --- 3. Extração (E) ---
+    print("Iniciando Extração (E)...")
+
+    try:
+        # Leitor multithread do Arrow, só com as colunas necessárias
+        df_kaggle = pd.read_csv(arquivo_csv, engine='pyarrow', usecols=COLUNAS_CSV, dtype_backend='pyarrow')
+        print(f"Arquivo {arquivo_csv} lido com sucesso. {len(df_kaggle)} linhas encontradas.")
+    except FileNotFoundError:
+        print(f"ERRO FATAL: Arquivo {arquivo_csv} não encontrado.")
+        return
+    except Exception as e:
+        print(f"Erro ao ler o arquivo CSV: {e}")
+        return
+
+    # --- 4. Transformação (T) ---
+    print("Iniciando Transformação (T)...")
+    # Trabalha direto sobre o DataFrame lido (df_kaggle não é usado depois), sem cópia
+    df_transformado = df_kaggle
+
+    # Um único gerador (PCG64) para todas as colunas simuladas
+    rng = np.random.default_rng()
+
+    try:
+        # 4.1. Simulação da 'data_pedido'
+        hoje = np.datetime64('today', 'D')
+        datas_pedido = hoje - np.arange(len(df_transformado), dtype='timedelta64[D]')
+        df_transformado['data_pedido'] = datas_pedido.astype('datetime64[ns]')
+        df_transformado['data_id'] = datas_pedido
+
+        # 4.2. Simulação da 'flag_entrega_prazo'
+        df_transformado['flag_entrega_prazo'] = rng.binomial(1, 0.85, size=len(df_transformado)).astype(np.int8)
+
+        # 4.3. IDs
+        # pd.factorize (sort=True) gera os mesmos códigos do .cat.codes sem criar a Categorical
+        codigos_forn, _ = pd.factorize(df_transformado['Supplier name'], sort=True)
+        codigos_transp, _ = pd.factorize(df_transformado['Shipping carriers'], sort=True)
+        df_transformado['forn_id'] = np.char.add('FORN_', codigos_forn.astype(str))
+        df_transformado['transp_id'] = np.char.add('CAR_', codigos_transp.astype(str))
+    
+        # 4.4. Padronização
+        df_transformado['sku_id'] = df_transformado['SKU']
+        df_transformado['nome_produto'] = df_transformado['SKU']
+        df_transformado['categoria'] = df_transformado['Product type']
+        df_transformado['nome_fornecedor'] = df_transformado['Supplier name']
+        df_transformado['localizacao'] = df_transformado['Location']
+        df_transformado['nome_transportadora'] = df_transformado['Shipping carriers']
+        df_transformado['modal'] = df_transformado['Transportation modes']
+        df_transformado['receita_total'] = df_transformado['Revenue generated']
+        df_transformado['custo_total'] = df_transformado['Manufacturing costs']
+        df_transformado['custo_transporte'] = df_transformado['Shipping costs']
+        df_transformado['taxa_nao_conformidade'] = df_transformado['Defect rates']
+        df_transformado['qtd_vendida'] = df_transformado['Number of products sold']
+        df_transformado['preco_venda'] = df_transformado['Price']
+        df_transformado['custo_fabricacao'] = df_transformado['Manufacturing costs']
+        df_transformado['nivel_estoque'] = df_transformado['Stock levels']
+    
+        # Limpeza de chaves nulas
+        print("Limpando dados...")
+        df_transformado.dropna(subset=['sku_id', 'forn_id', 'transp_id', 'data_id'], how='any', inplace=True)
+
+        # --- Dimensões ---
+        df_dim_produto = df_transformado[['sku_id', 'nome_produto', 'categoria', 'custo_fabricacao', 'preco_venda']].drop_duplicates(subset=['sku_id'])
+        df_dim_fornecedor = df_transformado[['forn_id', 'nome_fornecedor', 'localizacao']].drop_duplicates(subset=['forn_id'])
+        df_dim_transportadora = df_transformado[['transp_id', 'nome_transportadora', 'modal']].drop_duplicates(subset=['transp_id'])
     
-    print("Carga OLAP concluída com sucesso.")
+        # Deduplica primeiro e extrai ano/mês/dia só dos dias distintos
+        dias = np.unique(df_transformado['data_id'].to_numpy().astype('datetime64[D]'))
+        meses = dias.astype('datetime64[M]')
+        df_dim_tempo = pd.DataFrame({
+            'data_id': dias,
+            'ano': dias.astype('datetime64[Y]').astype(int) + 1970,
+            'mes': meses.astype(int) % 12 + 1,
+            'dia': (dias - meses).astype(int) + 1
+        })
+
+        # --- Fatos ---
+        df_transformado['margem_lucro'] = df_transformado['receita_total'] - df_transformado['custo_total']
+    
+        colunas_fato_vendas = [
+            'data_id', 'sku_id', 'forn_id', 'transp_id', 'receita_total', 'custo_total', 
+            'margem_lucro', 'qtd_vendida', 'custo_transporte', 'flag_entrega_prazo', 'taxa_nao_conformidade'
+        ]
+        # 32 bits bastam para as métricas: metade da memória e do payload do COPY
+        df_fato_vendas_final = df_transformado[colunas_fato_vendas].astype({
+            'receita_total': 'float32',
+            'custo_total': 'float32',
+            'margem_lucro': 'float32',
+            'custo_transporte': 'float32',
+            'taxa_nao_conformidade': 'float32',
+            'qtd_vendida': 'int32',
+            'flag_entrega_prazo': 'int8'
+        })
+
+        df_fato_estoque = df_transformado[['data_id', 'sku_id', 'nivel_estoque']].astype({'nivel_estoque': 'int32'})
+        df_fato_estoque['giro_estoque_mensal'] = rng.uniform(0.5, 5.0, size=len(df_fato_estoque)).astype(np.float32)
+        df_fato_estoque['risco_ruptura'] = rng.uniform(0.01, 0.9, size=len(df_fato_estoque)).astype(np.float32)
+
+        print("Transformação concluída.")
+
+    except Exception as e:
+        print(f"Erro na Transformação (T): {e}")
+        return
+
+    # --- 5. Carga (L) ---
+    print("Iniciando Carga (L)...")
+
+    try:
+        carregar_tabela(engine, df_dim_tempo, 'dim_tempo')
+        carregar_tabela(engine, df_dim_produto, 'dim_produto')
+        carregar_tabela(engine, df_dim_fornecedor, 'dim_fornecedor')
+        carregar_tabela(engine, df_dim_transportadora, 'dim_transportadora')
+        carregar_fato_paralelo(engine, df_fato_vendas_final, 'fato_vendas_logistica')
+        carregar_fato_paralelo(engine, df_fato_estoque, 'fato_estoque_analitico')
+    
+        print("Carga OLAP concluída com sucesso.")
+
+    except Exception as e:
+        print(f"Erro durante a Carga (L): {e}")
+
+
+if __name__ == "__main__":
+    DATABASE_URL = os.getenv("DATABASE_URL")
+    if not DATABASE_URL:
+        print("Erro: DATABASE_URL não definida.")
+        exit()
+
+    try:
+        engine = criar_engine(DATABASE_URL)
+        with engine.connect() as conn:
+            print("Conexão com PostgreSQL (Serviço 'db') estabelecida.")
+    except Exception as e:
+        print(f"Erro fatal ao conectar ao banco: {e}")
+        exit()
 
-except Exception as e:
-    print(f"Erro durante a Carga (L): {e}")
\ No newline at end of file
+    run_etl(engine)